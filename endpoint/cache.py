@@ -0,0 +1,52 @@
+import sqlite3
+from hashlib import blake2b
+from typing import Optional
+
+
+class TranslationCache:
+    def __init__(self, path: str, commit_interval: int = 100):
+        """Initialize on-disk translation cache
+
+        Args:
+            path: SQLite database file path, created if it does not exist
+            commit_interval: Number of new translations buffered before committing
+        """
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS translations (key BLOB PRIMARY KEY, value TEXT NOT NULL)")
+        self.conn.commit()
+        self.commit_interval = commit_interval
+        self._pending = 0
+
+    @staticmethod
+    def _key(target_language: str, text: str) -> bytes:
+        return blake2b(f"{target_language}\x00{text}".encode('utf-8'), digest_size=16).digest()
+
+    def get(self, target_language: str, text: str) -> Optional[str]:
+        """Return cached translation of text, None if not cached or cached empty"""
+        row = self.conn.execute(
+            "SELECT value FROM translations WHERE key = ?", (self._key(target_language, text),)
+        ).fetchone()
+        return row[0] if row and row[0] else None
+
+    def set(self, target_language: str, text: str, translation: str) -> None:
+        """Store translation of text, committing every commit_interval writes, empty translations are not stored"""
+        if not translation:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO translations (key, value) VALUES (?, ?)",
+            (self._key(target_language, text), translation)
+        )
+        self._pending += 1
+        if self._pending >= self.commit_interval:
+            self.commit()
+
+    def commit(self) -> None:
+        """Commit buffered translations"""
+        self.conn.commit()
+        self._pending = 0
+
+    def close(self) -> None:
+        """Commit buffered translations and close the database"""
+        self.commit()
+        self.conn.close()
@@ -1,10 +1,74 @@
 import os
+import re
 from typing import List, Optional, Callable, Any
 import aiohttp
 import asyncio
 from tqdm import tqdm
 import time
+import random
 import logging
+from endpoint.cache import TranslationCache
+
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> str:
+        return orjson.dumps(obj).decode()
+
+    json_loads = orjson.loads
+except ImportError:  # orjson is optional, fall back to the standard library
+    import json
+    json_dumps = json.dumps
+    json_loads = json.loads
+
+# Upper bound of a single retry backoff (seconds)
+MAX_RETRY_DELAY = 30.0
+
+# Progress bar refresh interval (seconds)
+PROGRESS_INTERVAL = 0.2
+
+# Number prefix of each line in a chunked translation response, e.g. "3. "
+LINE_NUMBER_RE = re.compile(r'^\s*(\d+)[.)]\s*', re.M)
+
+# Line break marker inside a chunked line, e.g. "1. First line <br> second line"
+LINE_BREAK_MARKER = " <br> "
+LINE_BREAK_RE = re.compile(r'\s*<br\s*/?>\s*', re.I)
+
+# Sentence boundary, the delimiter is kept with the preceding sentence; ".", "!" and "?" only end a
+# sentence when followed by whitespace, so decimals like "3.14" are not split
+SENTENCE_END_RE = re.compile(r'(?<=[.!?])(?=\s)|(?<=[。！？\n])')
+
+
+def split_for_translation(text: str, max_chars: int = 400) -> List[str]:
+    """Split text on sentence boundaries into parts of at most max_chars where possible
+    
+    Args:
+        text: Text to split
+        max_chars: Maximum number of characters of one part, a single longer sentence is kept whole
+    
+    Returns:
+        List of parts, joining them gives back the original text
+    """
+    parts: List[str] = []
+    current = ""
+    for sentence in SENTENCE_END_RE.split(text):
+        if current and len(current) + len(sentence) > max_chars:
+            parts.append(current)
+            current = ""
+        current += sentence
+    if current:
+        parts.append(current)
+    return parts
+
+
+def _surrounding_whitespace(source: str, translation: str) -> str:
+    """Put the leading and trailing whitespace of source around translation"""
+    stripped = source.strip()
+    if not stripped:
+        return source
+    start = source.index(stripped)
+    return source[:start] + translation.strip() + source[start + len(stripped):]
+
 
 # Configure logging
 logging.basicConfig(
@@ -14,12 +78,15 @@ logging.basicConfig(
 )
 
 class OpenAITranslator:
-    def __init__(self, api_key: str = None, api_base: str = "https://api.openai.com/v1"):
+    def __init__(self, api_key: str = None, api_base: str = "https://api.openai.com/v1",
+                 max_concurrency: int = 5, cache_path: Optional[str] = None):
         """Initialize OpenAI translator
         
         Args:
             api_key: OpenAI API key, if None, get from environment variable OPENAI_API_KEY
             api_base: API base URL, can be set to mirror site address
+            max_concurrency: Connection pool size of the shared session
+            cache_path: Translation cache database path, if None, translations are not cached
         """
         self.api_key = api_key or os.getenv("OPENAI_API_KEY")
         if not self.api_key:
@@ -30,22 +97,81 @@ class OpenAITranslator:
             "Content-Type": "application/json"
         }
         self.timeout = aiohttp.ClientTimeout(total=30)  # Set timeout to 30 seconds
+        self.max_concurrency = max_concurrency
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.cache_path = cache_path
+        self._cache: Optional[TranslationCache] = None
 
-    async def translate_text(self, text: str, target_language: str = "English", 
-                           session: Optional[aiohttp.ClientSession] = None,
-                           max_retries: int = 3,
-                           retry_delay: float = 2.0) -> str:
-        """Asynchronous translation of a single text
+    def _get_session(self) -> aiohttp.ClientSession:
+        """Return the shared session, creating it on first use so connections are kept alive across batches"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.max_concurrency,
+                limit_per_host=self.max_concurrency,
+                ttl_dns_cache=300,
+                keepalive_timeout=75
+            )
+            self._session = aiohttp.ClientSession(headers=self.headers, timeout=self.timeout, connector=connector,
+                                                  json_serialize=json_dumps)
+        return self._session
+
+    def _get_cache(self) -> Optional[TranslationCache]:
+        """Return the translation cache, opening it on first use, None if caching is disabled"""
+        if self.cache_path and self._cache is None:
+            self._cache = TranslationCache(self.cache_path)
+        return self._cache
+
+    async def aclose(self) -> None:
+        """Close the shared session and the translation cache"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+        if self._cache is not None:
+            self._cache.close()
+            self._cache = None
+
+    async def __aenter__(self) -> "OpenAITranslator":
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> None:
+        await self.aclose()
+
+    @staticmethod
+    def _backoff_delay(retry_delay: float, retry_count: int, retry_after: Optional[str] = None) -> float:
+        """Return how long to wait before the given retry
         
         Args:
-            text: Text to translate
-            target_language: Target language, default is English
-            session: aiohttp session, if None, create a new session
+            retry_delay: Base retry delay (seconds)
+            retry_count: Current retry count, starting from 1
+            retry_after: Value of the Retry-After header, if the server sent one
+        
+        Returns:
+            Delay in seconds, capped exponential backoff with jitter unless the server asked for a delay
+        """
+        if retry_after:
+            try:
+                return max(float(retry_after), 0.0)
+            except ValueError:
+                pass  # HTTP-date form is not supported, fall back to backoff
+        delay = min(retry_delay * (2 ** (retry_count - 1)), MAX_RETRY_DELAY)
+        return delay * (0.5 + random.random())
+
+    async def _complete(self, system_prompt: str, text: str, target_language: str,
+                        session: aiohttp.ClientSession,
+                        max_retries: int = 3,
+                        retry_delay: float = 2.0) -> Optional[str]:
+        """Send one chat completion request with retries
+        
+        Args:
+            system_prompt: System prompt of the request
+            text: User content of the request
+            target_language: Target language, used for logging
+            session: aiohttp session
             max_retries: Maximum number of retries
             retry_delay: Retry delay (seconds)
         
         Returns:
-            Translated text
+            Response content, None if all retries failed
         """
         retry_count = 0
         start_time = time.time()
@@ -56,94 +182,286 @@ class OpenAITranslator:
                 payload = {
                     "model": "gpt-4o-mini",
                     "messages": [
-                        {"role": "system", "content": f"You are a professional translator, please translate the following text into {target_language}, keep the original tone and style, only return the translation result."},
+                        {"role": "system", "content": system_prompt},
                         {"role": "user", "content": text}
                     ],
                     "temperature": 0.3
                 }
                 
-                should_close = session is None
-                if session is None:
-                    session = aiohttp.ClientSession(headers=self.headers, timeout=self.timeout)
-                
-                try:
-                    async with session.post(url, json=payload) as response:
-                        response.raise_for_status()
-                        result = await response.json()
-                        
-                        if "error" in result:
-                            raise Exception(result["error"]["message"])
-                        
-                        elapsed_time = time.time() - start_time
-                        if elapsed_time > 10:  # record request if it takes too long
-                            logging.warning(f"""
+                async with session.post(url, json=payload) as response:
+                    response.raise_for_status()
+                    result = json_loads(await response.read())
+                    
+                    if "error" in result:
+                        raise Exception(result["error"]["message"])
+                    
+                    elapsed_time = time.time() - start_time
+                    if elapsed_time > 10:  # record request if it takes too long
+                        logging.warning(f"""
 Request took too long ({elapsed_time:.2f} seconds):
 Original text: {text[:100]}...
 Target language: {target_language}
 Retry count: {retry_count}
 Response: {result}
 """)
-                        
-                        return result["choices"][0]["message"]["content"].strip()
-                finally:
-                    if should_close:
-                        await session.close()
+                    
+                    return result["choices"][0]["message"]["content"].strip()
                 
             except asyncio.TimeoutError:
                 retry_count += 1
                 if retry_count <= max_retries:
                     logging.warning(f"Timeout, retrying {retry_count} times... (Text: {text[:50]}...)")
-                    await asyncio.sleep(retry_delay * retry_count)  # 指数退避
+                    await asyncio.sleep(self._backoff_delay(retry_delay, retry_count))  # 指数退避
                 else:
-                    logging.error(f"Request timed out, returning original text. (Text: {text[:50]}...)")
-                    return text
+                    logging.error(f"Request timed out. (Text: {text[:50]}...)")
+                    return None
                     
             except Exception as e:
                 retry_count += 1
                 if retry_count <= max_retries:
+                    # honor the server's Retry-After on rate limiting
+                    retry_after = None
+                    if isinstance(e, aiohttp.ClientResponseError) and e.status == 429 and e.headers:
+                        retry_after = e.headers.get("Retry-After")
                     logging.warning(f"Error: {str(e)}, retrying {retry_count} times... (Text: {text[:50]}...)")
-                    await asyncio.sleep(retry_delay * retry_count)
+                    await asyncio.sleep(self._backoff_delay(retry_delay, retry_count, retry_after))
                 else:
-                    logging.error(f"Failed after {max_retries} retries: {str(e)}, returning original text. (Text: {text[:50]}...)")
-                    return text
+                    logging.error(f"Failed after {max_retries} retries: {str(e)}. (Text: {text[:50]}...)")
+                    return None
+
+    async def _translate_line(self, text: str, target_language: str,
+                              session: aiohttp.ClientSession,
+                              max_retries: int = 3,
+                              retry_delay: float = 2.0) -> Optional[str]:
+        """Translate a single text, return None if translation failed"""
+        system_prompt = f"You are a professional translator, please translate the following text into {target_language}, keep the original tone and style, only return the translation result."
+        return await self._complete(system_prompt, text, target_language, session, max_retries, retry_delay)
 
-    async def translate_batch(self, texts: List[str], target_language: str = "English", max_concurrency: int = 5) -> List[str]:
+    async def translate_text(self, text: str, target_language: str = "English", 
+                           session: Optional[aiohttp.ClientSession] = None,
+                           max_retries: int = 3,
+                           retry_delay: float = 2.0) -> str:
+        """Asynchronous translation of a single text
+        
+        Args:
+            text: Text to translate
+            target_language: Target language, default is English
+            session: aiohttp session, if None, use the translator's shared session
+            max_retries: Maximum number of retries
+            retry_delay: Retry delay (seconds)
+        
+        Returns:
+            Translated text, original text if translation failed
+        """
+        cache = self._get_cache()
+        if cache is not None:
+            cached = cache.get(target_language, text)
+            if cached is not None:
+                return cached
+        if session is None:
+            session = self._get_session()
+        result = await self._translate_line(text, target_language, session, max_retries, retry_delay)
+        if result is None:
+            logging.error(f"Returning original text. (Text: {text[:50]}...)")
+            return text
+        if cache is not None:
+            cache.set(target_language, text, result)
+            cache.commit()
+        return result
+
+    async def translate_chunk(self, texts: List[str], target_language: str = "English",
+                              session: Optional[aiohttp.ClientSession] = None,
+                              max_retries: int = 3,
+                              retry_delay: float = 2.0) -> Optional[List[str]]:
+        """Asynchronous translation of several texts in a single request
+        
+        Args:
+            texts: List of text to translate, sent as numbered lines
+            target_language: Target language, default is English
+            session: aiohttp session, if None, use the translator's shared session
+            max_retries: Maximum number of retries
+            retry_delay: Retry delay (seconds)
+        
+        Returns:
+            List of translated text, None if the request failed or the response does not match the input lines
+        """
+        if session is None:
+            session = self._get_session()
+        system_prompt = (f"You are a professional translator, please translate each numbered line of the following text into {target_language}, "
+                         f"keep the original tone and style. Output exactly {len(texts)} lines, each prefixed with its number, "
+                         f"keep every <br> marker where the line breaks, only return the translation result.")
+        # embedded line breaks are sent as markers so every text stays on one numbered line
+        text = "\n".join(f"{i + 1}. {t.replace(chr(10), LINE_BREAK_MARKER)}" for i, t in enumerate(texts))
+        result = await self._complete(system_prompt, text, target_language, session, max_retries, retry_delay)
+        if result is None:
+            return None
+        
+        # integrity check: numbers must be exactly 1..N in order
+        matches = list(LINE_NUMBER_RE.finditer(result))
+        if [int(m[1]) for m in matches] != list(range(1, len(texts) + 1)):
+            logging.warning(f"Chunk response has {len(matches)} numbered lines, expected {len(texts)}. (Text: {text[:50]}...)")
+            return None
+        bounds = [m.end() for m in matches]
+        starts = [m.start() for m in matches[1:]] + [len(result)]
+        translated = [LINE_BREAK_RE.sub("\n", result[b:e].strip()) for b, e in zip(bounds, starts)]
+        if any(not t and source.strip() for t, source in zip(translated, texts)):
+            logging.warning(f"Chunk response has an empty translation. (Text: {text[:50]}...)")
+            return None
+        return translated
+
+    async def translate_batch(self, texts: List[str], target_language: str = "English",
+                              max_concurrency: Optional[int] = None,
+                              order: str = "longest_first", chunk_size: int = 10,
+                              chunk_chars: int = 1500, split_chars: int = 400) -> List[str]:
         """Asynchronous batch translation of text
         
         Args:
             texts: List of text to translate
             target_language: Target language, default is English
-            max_concurrency: Maximum number of concurrent requests, default is 5
+            max_concurrency: Maximum number of concurrent requests, if None, use the connection pool size
+            order: Dispatch order, "longest_first", "shortest_first" or "original"; results keep input order
+            chunk_size: Maximum number of consecutive texts sent in one request, 1 disables chunking
+            chunk_chars: Maximum number of characters in one chunk
+            split_chars: Texts longer than this are split into sentence groups translated separately, 0 disables splitting
         
         Returns:
             List of translated text
         """
-        async with aiohttp.ClientSession(headers=self.headers, timeout=self.timeout) as session:
-            semaphore = asyncio.Semaphore(max_concurrency)
-            pbar = tqdm(total=len(texts), desc="Translation progress")
-            
-            async def translate_with_semaphore(text: str, index: int) -> tuple[int, str]:
-                async with semaphore:
-                    result = await self.translate_text(text, target_language, session)
-                    pbar.update(1)
-                    return index, result
-            
-            # Create task list, including index information
-            tasks = [translate_with_semaphore(text, i) for i, text in enumerate(texts)]
-            
-            # Wait for all tasks to complete
-            results = await asyncio.gather(*tasks, return_exceptions=True)
-            pbar.close()
-            
-            # Process results, including possible exceptions
-            processed_results = []
-            for i, result in enumerate(results):
-                if isinstance(result, Exception):
-                    logging.error(f"Task {i} failed: {str(result)}")
-                    processed_results.append((i, texts[i]))  # Return original text if exception occurs
+        if max_concurrency is None:
+            max_concurrency = self.max_concurrency
+        elif max_concurrency > self.max_concurrency:
+            logging.warning(f"Concurrency {max_concurrency} exceeds connection pool size {self.max_concurrency}, "
+                            f"extra workers will wait for a free connection")
+        session = self._get_session()
+        results: List[Optional[str]] = [None] * len(texts)
+        
+        # Reuse cached translations, only the remaining texts are sent
+        cache = self._get_cache()
+        pending = list(enumerate(texts))
+        if cache is not None:
+            pending = []
+            for index, text in enumerate(texts):
+                cached = cache.get(target_language, text)
+                if cached is None:
+                    pending.append((index, text))
                 else:
-                    processed_results.append(result)
-            
-            # Sort results by index
-            sorted_results = sorted(processed_results, key=lambda x: x[0])
-            return [result[1] for result in sorted_results]
+                    results[index] = cached
+            if len(pending) < len(texts):
+                logging.info(f"Reused {len(texts) - len(pending)} cached translations")
+        
+        # Split long texts into segments so their parts can be translated by several workers,
+        # then group consecutive short texts into chunks of (segment id, text)
+        segments: List[str] = []
+        segment_ids: dict[int, List[int]] = {}  # text index to its segment ids
+        segment_owner: List[tuple[int, str]] = []  # segment id to its (text index, text)
+        chunks: List[List[tuple[int, str]]] = []
+        chunk: List[tuple[int, str]] = []
+        chunk_len = 0
+        for index, text in pending:
+            parts = split_for_translation(text, split_chars) if split_chars and len(text) > split_chars else [text]
+            segment_ids[index] = list(range(len(segments), len(segments) + len(parts)))
+            for part in parts:
+                item = (len(segments), part)
+                segments.append(part)
+                segment_owner.append((index, text))
+                if len(parts) > 1:
+                    chunks.append([item])  # each part of a split text is dispatched on its own
+                    continue
+                if chunk and (len(chunk) >= chunk_size or chunk_len + len(part) > chunk_chars):
+                    chunks.append(chunk)
+                    chunk, chunk_len = [], 0
+                chunk.append(item)
+                chunk_len += len(part)
+        if chunk:
+            chunks.append(chunk)
+        segment_results: List[Optional[str]] = [None] * len(segments)
+        failed: set[int] = set()  # segments that fell back to the original text
+        remaining = {index: len(ids) for index, ids in segment_ids.items()}  # unfinished segments per text
+        
+        def finish_segment(segment_id: int, result: str, ok: bool = True) -> None:
+            # store the segment and, once all segments of its text are in, the joined text and its cache entry
+            segment_results[segment_id] = result
+            if not ok:
+                failed.add(segment_id)
+            index, text = segment_owner[segment_id]
+            remaining[index] -= 1
+            if remaining[index]:
+                return
+            ids = segment_ids[index]
+            if len(ids) == 1:
+                results[index] = result
+            else:
+                # join segments back together, keeping the whitespace around each source part
+                results[index] = "".join(
+                    _surrounding_whitespace(segments[i], segment_results[i]) for i in ids
+                )
+            if cache is not None and not failed.intersection(ids):
+                cache.set(target_language, text, results[index])
+        
+        # Starting the longest chunks first keeps them from becoming stragglers at the end of the batch
+        if order == "longest_first":
+            chunks.sort(key=lambda c: -sum(len(text) for _, text in c))
+        elif order == "shortest_first":
+            chunks.sort(key=lambda c: sum(len(text) for _, text in c))
+        elif order != "original":
+            raise ValueError(f"Unknown dispatch order: {order}")
+        queue: asyncio.Queue[List[tuple[int, str]]] = asyncio.Queue()
+        for chunk in chunks:
+            queue.put_nowait(chunk)
+        pbar = tqdm(total=len(segments), desc="Translation progress")
+        done = 0  # translated segments, shown by the progress ticker
+        
+        async def translate_lines(chunk: List[tuple[int, str]]) -> None:
+            if len(chunk) > 1:
+                translated = await self.translate_chunk([text for _, text in chunk], target_language, session)
+                if translated is not None:
+                    for (segment_id, _), result in zip(chunk, translated):
+                        finish_segment(segment_id, result)
+                    return
+                logging.warning(f"Falling back to per-line translation for {len(chunk)} texts")
+            for segment_id, text in chunk:
+                result = await self._translate_line(text, target_language, session)
+                if result is None:
+                    logging.error(f"Returning original text. (Text: {text[:50]}...)")
+                    finish_segment(segment_id, text, ok=False)
+                else:
+                    finish_segment(segment_id, result)
+        
+        async def progress_ticker() -> None:
+            # refresh the bar periodically instead of once per chunk
+            while True:
+                pbar.n = done
+                pbar.refresh()
+                await asyncio.sleep(PROGRESS_INTERVAL)
+        
+        async def worker() -> None:
+            nonlocal done
+            while True:
+                chunk = await queue.get()
+                try:
+                    await translate_lines(chunk)
+                except Exception as e:
+                    logging.error(f"Task {chunk[0][0]} failed: {str(e)}")
+                    for segment_id, text in chunk:
+                        if segment_results[segment_id] is None:
+                            finish_segment(segment_id, text, ok=False)  # Return original text if exception occurs
+                finally:
+                    done += len(chunk)
+                    queue.task_done()
+        
+        # A fixed pool of workers keeps at most max_concurrency requests in flight
+        workers = [asyncio.create_task(worker()) for _ in range(min(max_concurrency, len(chunks)))]
+        ticker = asyncio.create_task(progress_ticker())
+        try:
+            await queue.join()
+        finally:
+            for task in workers + [ticker]:
+                task.cancel()
+            await asyncio.gather(*workers, ticker, return_exceptions=True)
+            pbar.n = done
+            pbar.close()
+            # final flush, translations were written to the cache as they finished
+            if cache is not None:
+                cache.commit()
+        
+        return results
@@ -1,13 +1,61 @@
 import re
 from dataclasses import dataclass
-from typing import List
-from datetime import datetime
+from typing import List, Iterator, Optional, TextIO
+from operator import itemgetter
 import os
+import sys
 import argparse
 import asyncio
 from tqdm import tqdm
 from endpoint.endpoint import OpenAITranslator
 
+# number of entries written to the output file at once, and the output file buffer size
+WRITE_BATCH_SIZE = 4096
+WRITE_BUFFER_SIZE = 1 << 20
+
+# timing line of a subtitle block, e.g. "00:00:01,000 --> 00:00:02,500", milliseconds are optional
+_TIMING_RE = re.compile(
+    r'\s*((\d+):(\d+):(\d+)(?:[,.](\d+))?)\s*-->\s*((\d+):(\d+):(\d+)(?:[,.](\d+))?)'
+)
+
+# subtitle texts kept as-is instead of being translated: punctuation, symbols and numbers only, or sound tags
+_NOOP_RE = re.compile(r'^[\s\W\d_]*$')
+_NOOP_TAGS = {'[applause]', '[music]', '[laughter]', '♪'}
+
+def _to_milliseconds(hours: str, minutes: str, seconds: str, fraction: Optional[str]) -> int:
+    """convert matched timestamp fields to total milliseconds, a missing fraction counts as 0"""
+    milliseconds = int(fraction.ljust(3, '0')[:3]) if fraction else 0
+    return int(hours) * 3600000 + int(minutes) * 60000 + int(seconds) * 1000 + milliseconds
+
+def _iter_blocks(f: TextIO) -> Iterator[List[str]]:
+    """yield subtitle blocks (lists of lines) from an open srt file, one block at a time"""
+    buf = []
+    for line in f:
+        if line.strip() == "":
+            if buf:
+                yield buf
+                buf = []
+        else:
+            buf.append(line.rstrip('\n'))
+    if buf:
+        yield buf
+
+def load_history_map(file_path: str) -> dict[str, str]:
+    """load original to translation mapping from a merged translated srt file
+    
+    Args:
+        file_path: history translation file path
+    """
+    history_map = {}
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for lines in _iter_blocks(f):
+            # only 4-line blocks (index, time, original, translation) can be split unambiguously
+            if len(lines) != 4:
+                continue
+            # remove possible whitespace to improve matching rate
+            history_map[lines[2].strip()] = lines[3].strip()
+    return history_map
+
 @dataclass
 class SubtitleEntry:
     index: int
@@ -22,17 +70,6 @@ class SrtParser:
         self.source_language: str = ""  # source language
         self.translations: dict[str, List[str]] = {}  # translation results by target language
     
-    def parse_time(self, time_str: str) -> tuple[str, datetime]:
-        """parse timestamp string, return original string and datetime object tuple"""
-        time_str = time_str.strip()
-        # convert timestamp to datetime object for comparison
-        time_parts = time_str.replace(',', '.').split(':')
-        hours = int(time_parts[0])
-        minutes = int(time_parts[1])
-        seconds = float(time_parts[2])
-        total_seconds = hours * 3600 + minutes * 60 + seconds
-        return time_str, datetime.fromtimestamp(total_seconds)
-    
     def parse_file(self, file_path: str, source_language: str = "") -> List[SubtitleEntry]:
         """parse srt file
         
@@ -45,40 +82,36 @@ class SrtParser:
         self.translations.clear()
         
         with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # split subtitle blocks by empty lines
-        subtitle_blocks = content.strip().split('\n\n')
-        
-        # use tqdm to display parsing progress
-        for block in tqdm(subtitle_blocks, desc="Parsing subtitles"):
-            lines = block.strip().split('\n')
-            if len(lines) < 3:
-                continue
+            # read subtitle blocks separated by empty lines, using tqdm to display parsing progress
+            for lines in tqdm(_iter_blocks(f), desc="Parsing subtitles"):
+                if len(lines) < 3:
+                    continue
                 
-            # parse index
-            index = int(lines[0])
-            
-            # parse timestamp
-            time_line = lines[1]
-            start_time_str, end_time_str = time_line.split(' --> ')
-            start_time_str, start_time_obj = self.parse_time(start_time_str)
-            end_time_str, _ = self.parse_time(end_time_str)
-            
-            # get subtitle text (may span multiple lines)
-            text = '\n'.join(lines[2:])
+                # parse index
+                index = int(lines[0])
+                
+                # parse timestamp, skip blocks without a valid timing line
+                m = _TIMING_RE.match(lines[1])
+                if not m:
+                    tqdm.write(f"Skipped subtitle {index}: invalid timing line '{lines[1]}'")
+                    continue
+                start_time_str, end_time_str = m[1], m[6]
+                start_time_ms = _to_milliseconds(m[2], m[3], m[4], m[5])
+                
+                # get subtitle text (may span multiple lines)
+                text = '\n'.join(lines[2:])
+                
+                # create subtitle entry
+                entry = SubtitleEntry(
+                    index=index,
+                    start_time=start_time_str,
+                    end_time=end_time_str,
+                    content=text
+                )
+                self.entries.append((start_time_ms, entry))
             
-            # create subtitle entry
-            entry = SubtitleEntry(
-                index=index,
-                start_time=start_time_str,
-                end_time=end_time_str,
-                content=text
-            )
-            self.entries.append((start_time_obj, entry))
-        
         # sort by start time
-        self.entries.sort(key=lambda x: x[0])
+        self.entries.sort(key=itemgetter(0))
         # update index and extract sorted entries
         sorted_entries = []
         for i, (_, entry) in enumerate(self.entries, 1):
@@ -90,7 +123,7 @@ class SrtParser:
 
     async def translate_entries(self, translator: OpenAITranslator, target_language: str = "中文", 
                               max_concurrency: int = 5, use_history: bool = False,
-                              history_file: str = None) -> None:
+                              history_file: str = None, chunk_size: int = 10) -> None:
         """async translate all subtitle entries
         
         Args:
@@ -99,53 +132,58 @@ class SrtParser:
             max_concurrency: maximum concurrency
             use_history: whether to use history translation
             history_file: history translation file path
+            chunk_size: maximum number of subtitles sent in one request
         """
         # if use history translation, load history file first
         history_map = {}  # original to translation mapping
         if use_history and history_file:
             try:
-                history_parser = SrtParser()
-                history_parser.parse_file(history_file)
-                # create original to translation mapping
-                for entry in history_parser.entries:
-                    if entry.translated_content:  # only save entries with translation
-                        # use original as key, translation as value
-                        # remove possible whitespace and newline characters to improve matching rate
-                        key = entry.content.strip()
-                        history_map[key] = entry.translated_content.strip()
+                history_map = load_history_map(history_file)
                 print(f"Loaded {len(history_map)} history translation records")
             except Exception as e:
                 print(f"Failed to load history translation file: {str(e)}")
                 history_map = {}
 
-        # prepare texts to translate
-        texts_to_translate = []
+        # prepare texts to translate, grouping identical texts so each is only translated once
+        unique_entries: dict[str, List[SubtitleEntry]] = {}  # clean original to entries mapping
+        reused_count = 0
+        skipped_count = 0
         for entry in self.entries:
             # clean original text
             clean_content = entry.content.strip()
+            # keep texts with nothing to translate
+            if _NOOP_RE.match(clean_content) or clean_content.lower() in _NOOP_TAGS:
+                entry.translated_content = entry.content
+                skipped_count += 1
             # check if there is a matching history translation
-            if history_map and clean_content in history_map:
+            elif history_map and clean_content in history_map:
                 # use history translation
                 entry.translated_content = history_map[clean_content]
+                reused_count += 1
             else:
                 # add to translation list
-                texts_to_translate.append(entry.content)
+                unique_entries.setdefault(clean_content, []).append(entry)
+
+        if skipped_count:
+            print(f"Kept {skipped_count} texts without translatable content")
 
         # if there are still texts to translate, translate them
-        if texts_to_translate:
-            print(f"Need to translate {len(texts_to_translate)} new texts")
+        if unique_entries:
+            texts_to_translate = list(unique_entries.keys())
+            pending_count = sum(len(entries) for entries in unique_entries.values())
+            print(f"Need to translate {len(texts_to_translate)} new texts "
+                  f"({pending_count - len(texts_to_translate)} duplicates skipped)")
             if history_map:
-                print(f"Reused {len(history_map) - len(texts_to_translate)} history translations")
-            translated_texts = await translator.translate_batch(texts_to_translate, target_language, max_concurrency)
+                print(f"Reused {reused_count} history translations")
+            translated_texts = await translator.translate_batch(texts_to_translate, target_language, max_concurrency,
+                                                                chunk_size=chunk_size)
             
-            # update translation results
-            j = 0
-            for entry in self.entries:
-                if not entry.translated_content:  # if not using history translation
-                    entry.translated_content = translated_texts[j]
-                    j += 1
+            # update translation results for every entry sharing the same original
+            for text, translation in zip(texts_to_translate, translated_texts):
+                for entry in unique_entries[text]:
+                    entry.translated_content = translation
         else:
-            print("All texts have been found in history translations")
+            print("All texts have been found in history translations or need no translation")
         
         # store translation results
         self.translations[target_language] = [entry.translated_content for entry in self.entries]
@@ -161,14 +199,15 @@ class SrtParser:
         """
         if not separate_languages:
             # original merge save logic
-            with open(output_path, 'w', encoding='utf-8') as f:
+            with open(output_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f:
+                parts = []
                 for entry in tqdm(self.entries, desc="Saving subtitles"):
-                    f.write(f"{entry.index}\n")
-                    f.write(f"{entry.start_time} --> {entry.end_time}\n")
-                    f.write(f"{entry.content}\n")
-                    if entry.translated_content:
-                        f.write(f"{entry.translated_content}\n")
-                    f.write("\n")
+                    translated = f"{entry.translated_content}\n" if entry.translated_content else ""
+                    parts.append(f"{entry.index}\n{entry.start_time} --> {entry.end_time}\n{entry.content}\n{translated}\n")
+                    if len(parts) >= WRITE_BATCH_SIZE:
+                        f.write("".join(parts))
+                        parts.clear()
+                f.write("".join(parts))
             print(f"Saved merged subtitle file: {os.path.abspath(output_path)}")
         else:
             # separate save original and translation
@@ -176,24 +215,31 @@ class SrtParser:
             original_path = output_path.rsplit('.', 1)[0] + f'{lang_suffix}_original.srt'
             translated_path = output_path.rsplit('.', 1)[0] + f'_{target_language}.srt'
             
-            # save original
-            with open(original_path, 'w', encoding='utf-8') as f:
-                for entry in tqdm(self.entries, desc="Saving original subtitles"):
-                    f.write(f"{entry.index}\n")
-                    f.write(f"{entry.start_time} --> {entry.end_time}\n")
-                    f.write(f"{entry.content}\n\n")
+            # save original and translation in one pass, skipping untranslated entries in the translation file
+            has_translation = False
+            with open(original_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f_orig, \
+                    open(translated_path, 'w', encoding='utf-8', buffering=WRITE_BUFFER_SIZE) as f_trans:
+                original_parts = []
+                translated_parts = []
+                for entry in tqdm(self.entries, desc="Saving subtitles"):
+                    timing = f"{entry.index}\n{entry.start_time} --> {entry.end_time}\n"
+                    original_parts.append(f"{timing}{entry.content}\n\n")
+                    if entry.translated_content:
+                        has_translation = True
+                        translated_parts.append(f"{timing}{entry.translated_content}\n\n")
+                    if len(original_parts) >= WRITE_BATCH_SIZE:
+                        f_orig.write("".join(original_parts))
+                        f_trans.write("".join(translated_parts))
+                        original_parts.clear()
+                        translated_parts.clear()
+                f_orig.write("".join(original_parts))
+                f_trans.write("".join(translated_parts))
             print(f"Saved original subtitle file: {os.path.abspath(original_path)}")
             
-            # if there is translation, save translation
-            if any(entry.translated_content for entry in self.entries):
-                with open(translated_path, 'w', encoding='utf-8') as f:
-                    for entry in tqdm(self.entries, desc="Saving translated subtitles"):
-                        if entry.translated_content:  # skip untranslated entries
-                            f.write(f"{entry.index}\n")
-                            f.write(f"{entry.start_time} --> {entry.end_time}\n")
-                            f.write(f"{entry.translated_content}\n\n")
+            if has_translation:
                 print(f"Saved translated subtitle file: {os.path.abspath(translated_path)}")
             else:
+                os.unlink(translated_path)
                 print("No translation found, skipping save translation file")
 
     def split_translated_file(self, file_path: str) -> None:
@@ -205,43 +251,41 @@ class SrtParser:
         self.entries.clear()  # clear existing entries
         
         with open(file_path, 'r', encoding='utf-8') as f:
-            content = f.read()
-        
-        # split subtitle blocks by empty lines
-        subtitle_blocks = content.strip().split('\n\n')
-        
-        # use tqdm to display parsing progress
-        for block in tqdm(subtitle_blocks, desc="Parsing subtitles"):
-            lines = block.strip().split('\n')
-            if len(lines) < 4:  # at least 4 lines (index, time, original, translation)
-                continue
-            
-            # parse index
-            index = int(lines[0])
-            
-            # parse timestamp
-            time_line = lines[1]
-            start_time, end_time = time_line.split(' --> ')
-            
-            # get original and translation
-            content = lines[2]
-            translated_content = lines[3] if len(lines) > 3 else ""
+            # read subtitle blocks separated by empty lines, using tqdm to display parsing progress
+            for lines in tqdm(_iter_blocks(f), desc="Parsing subtitles"):
+                if len(lines) < 4:  # at least 4 lines (index, time, original, translation)
+                    continue
+                
+                # parse index
+                index = int(lines[0])
+                
+                # parse timestamp
+                time_line = lines[1]
+                start_time, end_time = time_line.split(' --> ')
+                
+                # get original and translation
+                content = lines[2]
+                translated_content = lines[3] if len(lines) > 3 else ""
+                
+                # create subtitle entry
+                entry = SubtitleEntry(
+                    index=index,
+                    start_time=start_time.strip(),
+                    end_time=end_time.strip(),
+                    content=content,
+                    translated_content=translated_content
+                )
+                self.entries.append(entry)
             
-            # create subtitle entry
-            entry = SubtitleEntry(
-                index=index,
-                start_time=start_time.strip(),
-                end_time=end_time.strip(),
-                content=content,
-                translated_content=translated_content
-            )
-            self.entries.append(entry)
-        
         # save separated file
         output_base = file_path.rsplit('.', 1)[0]
         self.save_translated_srt(output_base + '.srt', separate_languages=True)
 
 async def async_main(args: argparse.Namespace) -> None:
+    # let tasks that finish without blocking complete eagerly (Python 3.12+)
+    if sys.version_info >= (3, 12):
+        asyncio.get_running_loop().set_task_factory(asyncio.eager_task_factory)
+
     # initialize parser
     parser = SrtParser()
 
@@ -261,7 +305,9 @@ async def async_main(args: argparse.Namespace) -> None:
         if not args.sort_only:
             # initialize translator
             try:
-                translator = OpenAITranslator(api_key=args.api_key, api_base=args.api_base)
+                translator = OpenAITranslator(api_key=args.api_key, api_base=args.api_base,
+                                              max_concurrency=args.max_concurrency,
+                                              cache_path=args.cache_file)
             except ValueError as e:
                 print(f"Error: {str(e)}")
                 print("Please set OPENAI_API_KEY environment variable or use --api-key parameter to provide API key")
@@ -269,13 +315,15 @@ async def async_main(args: argparse.Namespace) -> None:
             
             # translate subtitles
             print(f"\nStart translating (target language: {args.target_language}, concurrency: {args.max_concurrency})")
-            await parser.translate_entries(
-                translator, 
-                args.target_language, 
-                args.max_concurrency,
-                args.use_history,
-                args.history_file
-            )
+            async with translator:
+                await parser.translate_entries(
+                    translator, 
+                    args.target_language, 
+                    args.max_concurrency,
+                    args.use_history,
+                    args.history_file,
+                    args.chunk_size
+                )
             output_file = args.input_file.rsplit('.', 1)[0] + f'_translated_{args.target_language}.srt'
         else:
             # sort only mode
@@ -304,6 +352,8 @@ def main():
                       help='API base URL (default: https://api.chatnio.net/v1)')
     parser.add_argument('--max-concurrency', '-m', type=int, default=5,
                       help='maximum concurrency (default: 5)')
+    parser.add_argument('--chunk-size', '-c', type=int, default=10,
+                      help='maximum number of subtitles sent in one request, 1 disables chunking (default: 10)')
     parser.add_argument('--sort-only', '-s', action='store_true',
                       help='sort subtitles only, no translation')
     parser.add_argument('--separate-output', '-p', action='store_true',
@@ -314,10 +364,24 @@ def main():
                       help='use history translation')
     parser.add_argument('--history-file', '-hf',
                       help='history translation file path (used with --use-history)')
+    parser.add_argument('--cache-file', '-cf',
+                      help='translation cache database path, reused across runs (optional)')
     args = parser.parse_args()
     
-    # run async main program
-    asyncio.run(async_main(args))
+    # run async main program, on uvloop (winloop on Windows) when installed
+    try:
+        if sys.platform == 'win32':
+            import winloop as uvloop
+        else:
+            import uvloop
+    except ImportError:
+        uvloop = None
+    if uvloop is not None and hasattr(uvloop, 'run'):
+        uvloop.run(async_main(args))
+    else:
+        if uvloop is not None:
+            uvloop.install()  # uvloop < 0.18 has no run()
+        asyncio.run(async_main(args))
 
 if __name__ == "__main__":
     main()